@@ -2,6 +2,7 @@
 ## Unlike ssi-bot, these are *not* necessarily finetuned on data from any subreddit
 ## Rather, they are prompted with a "character" to play (name + backstory)
 import requests
+from requests.adapters import HTTPAdapter
 import praw
 import csv
 import random
@@ -14,12 +15,16 @@ from hf_utils import generate_text, query
 from tagging_mixin import TaggingMixin
 import yaml
 import threading
-from nltk import word_tokenize
+from concurrent.futures import ThreadPoolExecutor
 from rake_nltk import Rake
-from googleapiclient import discovery
-import http.client, urllib.request, urllib.parse, urllib.error, base64
+import base64
 import json
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+import io
 from praw.models import Message as praw_Message
+from praw.models import Comment as praw_Comment
 
 _default_negative_keywords = [
     ('ar', 'yan'), ('ausch, witz'),
@@ -38,7 +43,71 @@ _default_negative_keywords = [
     ('sl', 'ut'), ('swas', 'tika'),
 ]
 
-_negative_keywords = ["".join(s) for s in _default_negative_keywords]
+_negative_keywords = frozenset("".join(s).casefold() for s in _default_negative_keywords)
+
+_word_re = re.compile(r'\S+')
+
+def keyword_trie_pattern(keywords):
+    # factor shared prefixes out of the keywords ("jew(?:ish|s)?" instead of "jew|jewish|jews")
+    # so the regex engine tries each position against a trie rather than every keyword in turn
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = {} # end of a keyword
+    def pattern(node):
+        branches = [re.escape(char) + pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches)==1 and '' not in node:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')' + ('?' if '' in node else '')
+    return pattern(trie)
+
+@lru_cache(maxsize=None)
+def build_keyword_regex(extra_keywords):
+    # one alternation scans the text once instead of once per keyword
+    # keywords are case-folded here and texts in bad_keyword, which beats re.IGNORECASE
+    keywords = _negative_keywords.union(k.casefold() for k in extra_keywords)
+    return re.compile(r"\b" + keyword_trie_pattern(keywords) + r"\b")
+
+def text_key(text):
+    # short fixed-size cache key, so cached texts don't have to be kept around
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+class LRUCache:
+    """
+    Small thread-safe least-recently-used cache for API results.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+def read_json(response, max_bytes):
+    # parse a streamed JSON response, refusing bodies larger than max_bytes
+    # so a misbehaving API can't make a reader thread buffer an arbitrary amount
+    if int(response.headers.get('Content-Length', 0)) > max_bytes:
+        raise ValueError('Response from {} is too large'.format(response.url))
+    body = response.raw.read(max_bytes+1, decode_content=True)
+    if len(body) > max_bytes:
+        raise ValueError('Response from {} is too large'.format(response.url))
+    return json.loads(body)
 
 ## Load config details from YAML
 def load_yaml(filename):
@@ -51,11 +120,16 @@ def load_yaml(filename):
 
 def words_below(string,max_words):
     # check to see if an input string would exceed token budget
-    token_list = word_tokenize(string)
-    if len(token_list)>max_words:
-        return False
-    else:
+    # every word needs at least one character plus a separator, so short strings can't be over
+    if len(string) < 2*max_words:
         return True
+    # otherwise count whitespace-separated words, stopping as soon as the limit is passed
+    word_count = 0
+    for word in _word_re.finditer(string):
+        word_count += 1
+        if word_count > max_words:
+            return False
+    return True
 
 def clean_text(generated_text):
     # look for double-quotes
@@ -68,26 +142,31 @@ def clean_text(generated_text):
     if truncate>-1:
         cleanStr = generated_text[:truncate]
         return cleanStr
-    # if we can't find a newline, look for the last terminal punctuation or start of new post
-    if re.search(r'[?.!(Reply|Post)]', generated_text):
-        trimPart = re.split(r'[?.!(Reply|Post)]', generated_text)[-1]
-        cleanStr = generated_text.replace(trimPart,'')
+    # if we can't find a newline, look for the last terminal punctuation
+    truncate = max(generated_text.rfind('?'), generated_text.rfind('.'), generated_text.rfind('!'))
+    if truncate>-1:
+        cleanStr = generated_text[:truncate+1]
         return cleanStr
-    # if we can't find a newline, use the last space
+    # if we can't find any punctuation, use the last space
     truncate = generated_text.rfind(' ')
     if truncate>-1:
         cleanStr = generated_text[:truncate]
         # using the last space may result in a trailing comma or colon; remove it
-        if cleanStr[-1] in ',;:':
+        if cleanStr and cleanStr[-1] in ',;:':
             cleanStr = cleanStr[:-1]
         return cleanStr
     # if we can't even find any spaces, give up
     return None
 
+# one shared extractor, since building a Rake reloads the stopword lists
+# it keeps the last text's results as state, so the reader threads take turns
+_rake = Rake()
+_rake_lock = threading.Lock()
+
 def get_keywords(text):
-    rake_nltk_var = Rake()
-    rake_nltk_var.extract_keywords_from_text(text)
-    keyword_extracted = rake_nltk_var.get_ranked_phrases()[:10]
+    with _rake_lock:
+        _rake.extract_keywords_from_text(text)
+        keyword_extracted = _rake.get_ranked_phrases()[:10]
     return keyword_extracted
 
 class reddit_bot:
@@ -97,39 +176,76 @@ class reddit_bot:
             print('Cannot load config file; check path and formatting')
             sys.exit()
         self.bot_backstory = self.config['bot_backstory']
+        # settings read on every streamed item, kept as attributes to save dict lookups in the loops
+        self.bot_username = self.config['bot_username']
+        self.character_budget = self.config['character_budget']
+        self.toxicity_threshold = self.config['toxicity_threshold']
+        self.topic_classifier = self.config['topic_classifier']
+        self.topic_threshold = self.config['topic_threshold']
+        self.topic_max_chars = self.config.get('topic_max_chars', 4000)
+        self.force_top_reply = self.config['force_top_reply']
+        self.linkpost_only = self.config['linkpost_only']
+        self.dynamic_prompt = self.config['dynamic_prompt']
+        self.max_levels = self.config['max_levels']
+        self.reply_textgen_model = self.config['reply_textgen_model']
         if self.config['topic_list']:
             self.topic_list = self.config['topic_list']
         else:
             self.topic_list = get_keywords(self.bot_backstory)
         self.HF_key = os.environ[self.config['HF_key_var']]
         self.headers = {"Authorization": "Bearer "+self.HF_key}
+        # keep-alive session so repeated image API calls skip the TLS handshake
+        # sized for the reader threads plus the worker pool hitting the same host
+        self._http = requests.Session()
+        self._http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        # worker threads for network calls that can overlap with other work
+        self._pool = ThreadPoolExecutor(max_workers=4)
         self.DeepAI_API_key = os.environ[self.config['deepai_api_key_var']]
         self.Google_API_key = os.environ[self.config['Google_API_key_var']]
         self.Azure_token = os.environ[self.config['azure_token_var']]
+        # Settings below for Azure vision; only the image URL changes between calls
+        self._azure_headers = {
+            # Request headers
+            'Ocp-Apim-Subscription-Key': self.Azure_token
+        }
+        self._azure_params = {
+            # Request parameters
+            'maxCandidates': '1',
+            'language': 'en',
+            'model-version': 'latest',
+        }
         self.reddit = praw.Reddit(
-            user_agent=self.config['bot_username'],
+            user_agent=self.bot_username,
             client_id=self.config['reddit_ID'],
             client_secret=self.config['reddit_secret'],
-            username=self.config['bot_username'],
+            username=self.bot_username,
             password=self.config['reddit_pass'],
         )
         self.me = self.reddit.user.me()
+        self._me_name = self.me.name.lower() # for cheap author comparisons in the stream loops
         self.reddit.validate_on_submit = True
         self.sub = self.reddit.subreddit(self.config['bot_subreddit'])
-        self.submission_writer = threading.Thread(target=self.submission_loop, args=())
         self.submission_reader = threading.Thread(target=self.watch_submissions, args=())
         self.inbox_reader = threading.Thread(target=self.watch_inbox, args=())
-        self.today = date.today()
+        self._today_ordinal = date.today().toordinal()
         self.tally = 0 # to compare with daily input character budget
+        self._tally_lock = threading.Lock() # the tally is shared by all the bot's threads
         self.SSI = TaggingMixin() # handler for legacy SSI tagging functions
-        self.negative_keywords = _negative_keywords + self.config['negative_keywords']
-        self.perspective = discovery.build(
-         "commentanalyzer",
-         "v1alpha1",
-         developerKey=self.Google_API_key,
-         discoveryServiceUrl="https://commentanalyzer.googleapis.com/$discovery/rest?version=v1alpha1",
-         static_discovery=False,
-        )
+        # compiled once per distinct keyword list, however many bots are created
+        self._bad_re = build_keyword_regex(tuple(sorted(self.config['negative_keywords'])))
+        # Perspective is called over the pooled session; the discovery client's httplib2
+        # transport isn't thread-safe and reconnects often
+        self._perspective_url = "https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze"
+        # key in a header rather than the query string, so it can't end up in logged URLs
+        self._perspective_headers = {'X-Goog-Api-Key': self.Google_API_key}
+        # fullnames of submissions and comments the bot has replied to,
+        # so threads need not be fetched to check
+        self._replied_to = set()
+        self.load_reply_history()
+        # API results for recently seen inputs; the same post or comment is often checked more than once
+        self._captions = LRUCache(1024)
+        self._toxicity_scores = LRUCache(4096)
+        self._topic_scores = LRUCache(4096)
         self.comments_seen = 0
         self.posts_seen = 0
         self.posts_made = 0
@@ -141,91 +257,200 @@ class reddit_bot:
         status['comments_seen'] = self.comments_seen
         status['posts_made'] = self.posts_made
         status['comments_made'] = self.comments_made
-        status['percent'] = round(100*(self.tally/self.config['character_budget']))
+        status['percent'] = round(100*(self.tally/self.character_budget))
         print("READ: submissions={posts_seen}\tcomment={comments_seen}\t| WRITE: post={posts_made}\treply={comments_made}\t| SPEND={percent}%".format(**status))
 
     def bad_keyword(self,text):
-        return [keyword for keyword in self.negative_keywords if re.search(r"\b{}\b".format(keyword), text, re.IGNORECASE)]
+        # stops at the first hit; callers only need to know whether there was one
+        return self._bad_re.search(text.casefold()) is not None
 
-    def is_toxic(self,text):
-        analyze_request = {
+    def toxicity_request(self,text):
+        return {
          'comment': { 'text': text },
          'requestedAttributes': {'TOXICITY': {}},
          'languages': 'en'
         }
-        try:
-            response = self.perspective.comments().analyze(body=analyze_request).execute()
-        except:
+
+    def perspective_score(self,text):
+        # one Perspective request; None if it fails
+        # the default quota is one query per second, so a rate-limited request waits and
+        # retries instead of counting as a failure (which would reject the text as toxic)
+        attempts = 3
+        for attempt in range(attempts):
+            try:
+                response = self._http.post(self._perspective_url, headers=self._perspective_headers, json=self.toxicity_request(text), timeout=(5, 15))
+            except Exception as e:
+                # only the type; the message can include request details
+                print("Perspective request failed: "+type(e).__name__)
+                return None
+            if response.status_code == 429:
+                if attempt+1 < attempts:
+                    time.sleep(attempt + 1)
+                continue
+            if response.status_code != requests.codes.ok:
+                print("Perspective request failed, status code "+str(response.status_code))
+                return None
+            try:
+                return response.json()['attributeScores']['TOXICITY']['summaryScore']['value']
+            except Exception as e:
+                print("Invalid Perspective response: "+type(e).__name__)
+                return None
+        print("Perspective rate limit still exceeded, giving up")
+        return None
+
+    def score_toxicity(self,texts):
+        # get Perspective toxicity scores for a list of texts
+        # texts not scored recently are sent one at a time, since the default quota is one query per second
+        # a score is None where checking failed
+        keys = [text_key(text) for text in texts]
+        scores = [self._toxicity_scores.get(key) for key in keys]
+        for k in range(len(texts)):
+            if not texts[k].strip():
+                # Perspective rejects empty comments; there is nothing toxic to find anyway
+                scores[k] = 0.0
+        # identical texts (duplicate generations, say) share one request
+        pending = {}
+        for k in range(len(texts)):
+            if scores[k] is None:
+                pending.setdefault(keys[k], []).append(k)
+        for key, indices in pending.items():
+            score = self.perspective_score(texts[indices[0]])
+            if score is not None:
+                self._toxicity_scores.put(key, score)
+            for k in indices:
+                scores[k] = score
+        return scores
+
+    def toxic_score(self,score):
+        if score is None:
             print("Toxicity checking failed!")
             return True
-        score = response['attributeScores']['TOXICITY']['summaryScore']['value']
         print(f"Perspective toxicity summary score = {score}")
-        if score>self.config['toxicity_threshold']:
+        if score>self.toxicity_threshold:
             return True
         else:
             return False
 
+    def is_toxic(self,text):
+        return self.toxic_score(self.score_toxicity([text])[0])
+
+    def screen_texts(self,texts):
+        # yield the generated texts that pass both the keyword and toxicity checks, in order
+        # each one is scored only when the caller asks for it, so a caller that takes the
+        # first acceptable text sends nothing to Perspective for the rest
+        for text in texts:
+            print(f"GENERATED: {text}")
+            if self.bad_keyword(text):
+                print("Generated text contains a negative keyword, discarded.")
+            elif self.is_toxic(text):
+                print("Generated text failed toxicity check, discarded.")
+            else:
+                yield text
+
     def on_topic(self,text,topic_list):
-        payload = {
-            "inputs": text,
-            "parameters": {"candidate_labels": topic_list,"multi_label": True},
-            "options": {"use_cache": False, "wait_for_model": True}
-        }
-        if not self.check_budget(text):
-            print("Not enough characters left in budget to check topic")
-            return False
-        self.tally += len(text)
-        self.report_status()
-        print(f'Checking text: {text}')
-        results = query(payload, self.config['topic_classifier'], self.headers)
-        if not results:
-            print('Topic checking failed!')
-            return False
-        for k in range(len(topic_list)):
-            topic = topic_list[k]
-            score = results['scores'][k]
-            if score > self.config['topic_threshold']:
-                print('"{}": {}'.format(topic,round(score,1)))
-                return True
-        # otherwise
-        return False
+        return self.batch_on_topic([text],topic_list)[0]
 
-    def check_budget(self,string):
-        # check to see if an input string would exceed character budget
-        # first, check the date; reset it and the tally if changed
-        if date.today() != self.today:
+    def batch_on_topic(self,texts,topic_list):
+        # check whether each text is on one of the topics, classifying all of them in one request
+        # the classifier truncates at about 1024 tokens (~4000 characters of English),
+        # so text past that point would use up budget without changing the result
+        texts = [text[:self.topic_max_chars] for text in texts]
+        keys = [(text_key(text), tuple(topic_list)) for text in texts]
+        # texts classified recently need no budget spent on them again
+        best = [self._topic_scores.get(key) for key in keys]
+        pending = [k for k in range(len(texts)) if best[k] is None]
+        if pending:
+            inputs = [texts[k] for k in pending]
+            payload = {
+                "inputs": inputs,
+                "parameters": {"candidate_labels": topic_list,"multi_label": True},
+                # classification is deterministic, so let the API serve repeated inputs from its cache
+                "options": {"use_cache": True, "wait_for_model": True}
+            }
+            if not self._spend(sum(len(text) for text in inputs)):
+                print("Not enough characters left in budget to check topic")
+            else:
+                self.report_status()
+                for text in inputs:
+                    print(f'Checking text: {text}')
+                try:
+                    results = query(payload, self.topic_classifier, self.headers)
+                except Exception as e:
+                    print('Topic classifier request failed: '+type(e).__name__)
+                    results = None
+                if not results:
+                    print('Topic checking failed!')
+                else:
+                    if not isinstance(results, list):
+                        results = [results]
+                    for k, result in zip(pending, results):
+                        # an error body or an entry without labels counts as a failed check, and isn't cached
+                        if not (isinstance(result, dict) and result.get('labels') and result.get('scores')):
+                            print('Invalid topic classification: {}'.format(result))
+                            continue
+                        # labels come back sorted by score, so only the best one needs checking
+                        best[k] = (result['labels'][0], result['scores'][0])
+                        self._topic_scores.put(keys[k], best[k])
+        topical = []
+        for k in range(len(texts)):
+            if best[k] and best[k][1] > self.topic_threshold:
+                print('"{}": {}'.format(best[k][0],round(best[k][1],1)))
+                topical.append(True)
+            else:
+                topical.append(False)
+        return topical
+
+    def comment_on_topical(self,submissions):
+        # classify a burst of new submissions together, then comment on the ones that fit
+        for submission, topical in zip(submissions, self.batch_on_topic([s.title for s in submissions],self.topic_list)):
+            if topical:
+                print("Generating a comment on submission "+submission.id)
+                # one bad post mustn't lose the rest of the batch
+                try:
+                    self.make_comment(submission)
+                except Exception as e:
+                    print("Failed to comment on submission "+submission.id+": "+str(e))
+
+    def _check_date(self):
+        # reset the tally when the day changes; callers hold _tally_lock
+        today_ordinal = date.today().toordinal()
+        if today_ordinal != self._today_ordinal:
             # reset the character budget and date
-            self.today = date.today()
+            self._today_ordinal = today_ordinal
             self.tally = 0
-        character_cost = len(string)
-        if (self.tally + character_cost) < self.config['character_budget']:
+
+    def _spend(self,character_cost):
+        # charge character_cost against the daily budget if it fits, returning whether it did
+        # check and increment happen under one lock, so threads can't overspend between them
+        with self._tally_lock:
+            self._check_date()
+            if (self.tally + character_cost) >= self.character_budget:
+                return False
+            self.tally += character_cost
             return True
-        else:
-            return False
 
-    def describe_image(self,url):
-        # Settings below for Azure vision
-        headers = {
-            # Request headers
-            'Content-Type': 'application/json',
-            'Ocp-Apim-Subscription-Key': self.Azure_token
-        }
+    def check_budget(self,string):
+        # check to see if an input string would exceed character budget, without spending anything
+        with self._tally_lock:
+            self._check_date()
+            return (self.tally + len(string)) < self.character_budget
 
-        params = urllib.parse.urlencode({
-            # Request parameters
-            'maxCandidates': '1',
-            'language': 'en',
-            'model-version': 'latest',
-        })
+    def describe_image(self,url):
+        caption = self._captions.get(url)
+        if caption:
+            return caption
         caption = ''
+        if not self.config['azure_endpoint']:
+            return caption # captioning is optional; no endpoint configured
         try:
-            conn = http.client.HTTPSConnection(self.config['azure_endpoint'])
-            conn.request("POST", "/vision/v3.2/describe?%s" % params, '{"url":"'+url+'"}', headers)
-            response = conn.getresponse()
-            data = json.loads(response.read())
+            azure_url = "https://"+self.config['azure_endpoint']+"/vision/v3.2/describe"
+            # json= also sets the Content-Type and escapes the URL properly
+            # the with block returns the connection to the pool even when parsing fails
+            with self._http.post(azure_url, params=self._azure_params, json={'url': url}, headers=self._azure_headers, timeout=(5, 30), stream=True) as response:
+                data = read_json(response, 1000000)
             #print(data)
             caption = 'A picture of ' + data['description']['captions'][0]['text']
-            conn.close()
+            self._captions.put(url, caption)
             print("Caption: "+caption)
         except Exception as e:
             print(e)
@@ -233,18 +458,18 @@ class reddit_bot:
 
     def generate_image(self,prompt):
         endpoint = 'https://hf.space/embed/multimodalart/latentdiffusion/+/api/predict/'
-        r = requests.post(url=endpoint, json={"data": [prompt,50,'256','256',1,1]})
-        r_json = r.json()
+        # diffusion can take minutes on a shared Space, but shouldn't hang the post writer forever
+        with self._http.post(url=endpoint, json={"data": [prompt,50,'256','256',1,1]}, timeout=(10, 300), stream=True) as r:
+            r_json = read_json(r, 20000000)
         b = base64.b64decode(r_json["data"][0].split(",")[1])
-        with open("tmp.jpg", "wb") as outfile:
-            outfile.write(b)
         # upscale API
-        r2 = requests.post(
+        r2 = self._http.post(
             "https://api.deepai.org/api/torch-srgan",
             files={
-                'image': open('tmp.jpg', 'rb'),
+                'image': ('tmp.jpg', io.BytesIO(b), 'image/jpeg'),
             },
-            headers={'api-key': self.DeepAI_API_key}
+            headers={'api-key': self.DeepAI_API_key},
+            timeout=(10, 120),
         )
         r2_json = r2.json()
         url = r2_json['output_url']
@@ -261,10 +486,9 @@ class reddit_bot:
                 prompt = '<|sols'
             else:
                 prompt = '<|soss'
-            if not self.check_budget(prompt):
+            if not self._spend(len(prompt)):
                 print("Not enough characters left in budget to make a post!")
                 return None
-            self.tally += len(prompt)
             self.report_status()
             print("Generating a post on r/"+self.sub.display_name)
             post_params = self.config['post_textgen_parameters']
@@ -272,11 +496,7 @@ class reddit_bot:
             if not stringlist:
                 print("Text generation failed!")
                 return None
-            for generated_text in stringlist:
-                print(f"GENERATED: {generated_text}")
-                if self.bad_keyword(generated_text) or self.is_toxic(generated_text):
-                    print("Generated text failed toxicity check, discarded.")
-                    continue
+            for generated_text in self.screen_texts(stringlist):
                 post = self.SSI.extract_submission_from_generated_text(generated_text)
                 if not post:
                     print("Failed to extract post from generated text!")
@@ -300,19 +520,19 @@ class reddit_bot:
         for attempt in range(self.config['post_tries']):
             # one-shot post generation
             prompt = self.bot_backstory
-            prompt = '\n'.join([prompt,'Title of a Reddit post by u/{}: "'.format(self.config['bot_username'])])
-            if not self.check_budget(prompt):
+            prompt = '\n'.join([prompt,'Title of a Reddit post by u/{}: "'.format(self.bot_username)])
+            if not self._spend(len(prompt)):
                 print("Not enough characters left in budget to make a post!")
                 return None
-            self.tally += len(prompt)
             print("Generating a post on r/"+self.sub.display_name)
             # use the reply model to generate post title
             post_params = self.config['reply_textgen_parameters']
-            stringlist = generate_text(prompt,self.config['reply_textgen_model'],post_params,self.headers)
+            stringlist = generate_text(prompt,self.reply_textgen_model,post_params,self.headers)
             if not stringlist:
                 print("Text generation failed!")
                 return None
             post = {}
+            titles = []
             for generated_text in stringlist:
                 # post titles should be a single line
                 truncate = generated_text.rfind('\n')
@@ -325,11 +545,10 @@ class reddit_bot:
                 if len(cleanStr)>300:
                     print("Generated text too long for Reddit post title, skipping")
                     continue
-                print(f"GENERATED: {cleanStr}")
-                if self.bad_keyword(cleanStr) or self.is_toxic(cleanStr):
-                    print("Generated text failed toxicity check, discarded.")
-                    continue
+                titles.append(cleanStr)
+            for cleanStr in self.screen_texts(titles):
                 post['title'] = cleanStr
+                break
             if 'title' not in post.keys():
                 print("Unable to generate an acceptable post title!")
                 return None
@@ -343,23 +562,22 @@ class reddit_bot:
                     continue
             else:
                 prompt = prompt + post['title'] + '"'
-                prompt = '\n'.join([prompt,'Post body: "'.format(self.config['bot_username'])])
-                if not self.check_budget(prompt):
+                prompt = '\n'.join([prompt,'Post body: "'.format(self.bot_username)])
+                if not self._spend(len(prompt)):
                     print("Not enough characters left in budget to generate post body!")
                     return None
                 else:
-                    self.tally += len(prompt)
-                    stringlist = generate_text(prompt,self.config['reply_textgen_model'],post_params,self.headers)
+                    stringlist = generate_text(prompt,self.reply_textgen_model,post_params,self.headers)
+                    bodies = []
                     for generated_text in stringlist:
                         cleanStr = clean_text(generated_text)
                         if not cleanStr:
                             print("Invalid generation, skipping...")
                             continue
-                        print(f"GENERATED: {cleanStr}")
-                        if self.bad_keyword(cleanStr) or self.is_toxic(cleanStr):
-                            print("Generated text failed toxicity check, discarded.")
-                            continue
+                        bodies.append(cleanStr)
+                    for cleanStr in self.screen_texts(bodies):
                         post['selftext'] = cleanStr
+                        break
                 if 'selftext' not in post.keys():
                     try:
                         submission = self.sub.submit(title=post['title'],selftext='',flair_id=self.config['post_flair'])
@@ -380,60 +598,80 @@ class reddit_bot:
         # if none of the posts passed the checks
         return None
 
+    def load_reply_history(self):
+        # seed the replied set from the bot's recent comments, covering earlier runs
+        # a comment's parent_id is the fullname of whatever it replied to
+        for comment in self.me.comments.new(limit=200):
+            self._replied_to.add(comment.parent_id)
+
+    def _reply(self, target, body):
+        # reply to a submission or comment and remember having done so
+        reply = target.reply(body=body)
+        self._replied_to.add(target.fullname)
+        return reply
+
     def generate_reply(self, comment):
         print("Generating a reply to comment:\n"+comment.body)
         reply = None
         # accumulate comment thread for context
         at_top = False
-        prompt = 'Reply by u/{}: "'.format(self.config['bot_username'])
+        prompt = 'Reply by u/{}: "'.format(self.bot_username)
         thread_item = comment
-        for level in range(self.config['max_levels']):
+        thread_post = comment.submission
+        # fetching the post brings its comment tree along, so look up ancestors there
+        # instead of requesting each parent separately
+        thread_comments = {c.fullname: c for c in thread_post.comments.list() if isinstance(c, praw_Comment)}
+        caption = None
+        if not thread_post.is_self:
+            # describe the image in the background while the thread is accumulated
+            caption = self._pool.submit(self.describe_image, thread_post.url)
+        for level in range(self.max_levels):
             prompt = '\n'.join(['Comment by u/{}: "{}"'.format(thread_item.author.name, thread_item.body),prompt])
             if thread_item.parent_id[:2]=='t3':
                 # next thing is the post, not a comment
                 # To do: image recognition/description for link posts
                 at_top = True
-                thread_post = comment.submission
                 thread_OP = thread_post.author.name
                 post_title = thread_post.title
                 if thread_post.is_self:
                     post_body = thread_post.selftext
                     prompt = '\n'.join(['Post by u/{} titled "{}": "{}"'.format(thread_OP,post_title,post_body),prompt])
                 else:
-                    alt_text = self.describe_image(thread_post.url)
+                    alt_text = caption.result()
                     prompt = '\n'.join(['Image post by u/{} titled "{}": {}'.format(thread_OP,post_title,alt_text),prompt])
                 break
             else:
-                thread_item = thread_item.parent()
+                thread_item = thread_comments.get(thread_item.parent_id) or thread_item.parent()
+        if caption and not at_top:
+            # the post is not part of the prompt after all
+            caption.cancel()
         # if not at_top:
         #     print("Post not in prompt, discarding")
         #     return None
         prompt = '\n'.join([self.bot_backstory,prompt])
-        if not self.check_budget(prompt):
+        if not self._spend(len(prompt)):
             print("Prompt is too long, skipping...")
             return None
-        self.tally += len(prompt)
         self.report_status()
         print(f"PROMPT: {prompt}")
         reply_params = self.config['reply_textgen_parameters']
         try:
-            stringlist = generate_text(prompt,self.config['reply_textgen_model'],reply_params,self.headers)
+            stringlist = generate_text(prompt,self.reply_textgen_model,reply_params,self.headers)
         except:
             print("Generation failed, skipping...")
             return None
         if not stringlist:
             print("Generation failed, skipping...")
             return None
+        replies = []
         for generated_text in stringlist:
             cleanStr = clean_text(generated_text)
             if not cleanStr:
                 print("Invalid generation, skipping...")
                 continue
-            print(f"GENERATED: {cleanStr}")
-            if self.is_toxic(cleanStr):
-                print("Text is toxic, skipping...")
-                continue
-            reply = comment.reply(body=clean_text(cleanStr)) # sometimes need a 2nd wash
+            replies.append(cleanStr)
+        for cleanStr in self.screen_texts(replies):
+            reply = self._reply(comment, clean_text(cleanStr)) # sometimes need a 2nd wash
             print("Reply successful!")
             self.comments_made += 1
             self.report_status()
@@ -446,7 +684,7 @@ class reddit_bot:
         thread_OP = submission.author.name
         post_title = submission.title
         print("Commenting on submission:\n"+post_title)
-        prompt = 'Comment by u/{}: "'.format(self.config['bot_username'])
+        prompt = 'Comment by u/{}: "'.format(self.bot_username)
         if submission.is_self:
             post_body = submission.selftext
             prompt = '\n'.join(['Post by u/{} titled "{}": "{}"'.format(thread_OP,post_title,post_body),prompt])
@@ -454,90 +692,109 @@ class reddit_bot:
             alt_text = self.describe_image(submission.url)
             prompt = '\n'.join(['Image post by u/{} titled "{}": {}'.format(thread_OP,post_title,alt_text),prompt])
         prompt = '\n'.join([self.bot_backstory,prompt])
-        if not self.check_budget(prompt):
+        if not self._spend(len(prompt)):
             print("Prompt is too long, skipping...")
             return None
-        self.tally += len(prompt)
         self.report_status()
         print(f"PROMPT: {prompt}")
         reply_params = self.config['reply_textgen_parameters']
-        stringlist = generate_text(prompt,self.config['reply_textgen_model'],reply_params,self.headers)
+        stringlist = generate_text(prompt,self.reply_textgen_model,reply_params,self.headers)
         if not stringlist:
             print("Generation failed, skipping...")
             return None
+        comments = []
         for generated_text in stringlist:
             cleanStr = clean_text(generated_text)
             if not cleanStr:
                 print("Invalid generation, skipping...")
+                break
+            comments.append(cleanStr)
+        for cleanStr in self.screen_texts(comments):
+            try:
+                reply = self._reply(submission, cleanStr)
+                print("Comment successful!")
+                self.comments_made += 1
+                self.report_status()
+                return reply
+            except:
+                print("Comment failed, sorry...")
                 return None
-            print(f"GENERATED: {cleanStr}")
-            if self.is_toxic(cleanStr) or self.bad_keyword(cleanStr):
-                print("Text is toxic, skipping...")
-            else:
-                try:
-                    reply = submission.reply(body=cleanStr)
-                    print("Comment successful!")
-                    self.comments_made += 1
-                    self.report_status()
-                    return reply
-                except:
-                    print("Comment failed, sorry...")
-                    return None
         # no valid replies
         return None
 
     def watch_submissions(self):
         # watch for posts
+        idle_backoff = 1
+        # submissions waiting for a topic check; flushed when the stream runs dry
+        candidates = []
         while True:
             try:
                 for submission in self.sub.stream.submissions(pause_after=0,skip_existing=True):
                     # decide whether to reply to a post
                     if not submission:
+                        if candidates:
+                            batch, candidates = candidates, []
+                            self.comment_on_topical(batch)
+                        # nothing new; with pause_after=0 PRAW polls again at once unless we wait
+                        time.sleep(idle_backoff)
+                        idle_backoff = min(idle_backoff*2, 30)
                         continue
+                    idle_backoff = 1
                     self.posts_seen += 1
-                    if submission.author == self.me:
-                        continue
-                    if self.bad_keyword(submission.title) or (submission.is_self and self.bad_keyword(submission.selftext)):
+                    # deleted authors are skipped too; make_comment needs the OP's name
+                    if not submission.author or submission.author.name.lower() == self._me_name:
                         continue
-                    if self.is_toxic(submission.title) or (submission.is_self and self.is_toxic(submission.selftext)):
+                    # local checks first, so rejected posts never reach the toxicity API
+                    # title and body are scanned as one string (original case, bad_keyword folds it once)
+                    post_string = submission.title
+                    if submission.is_self:
+                        post_string = '\n'.join([submission.title, submission.selftext])
+                    if self.bad_keyword(post_string):
                         continue
-                    if self.config['linkpost_only']==2 and not submission.is_self:
-                        # force reply to image posts
-                        self.make_comment(submission)
+                    if self.linkpost_only==1 and submission.is_self:
                         continue
-                    elif self.config['linkpost_only']==1 and submission.is_self:
+                    if submission.fullname in self._replied_to:
                         continue
-                    already_replied = False
-                    submission.comments.replace_more(limit=None)
-                    for comment in submission.comments:
-                        if comment.author == self.reddit.user.me():
-                            already_replied = True
-                            break
-                    if already_replied:
+                    # the body is only scored if the title passes
+                    texts = [submission.title]
+                    if submission.is_self:
+                        texts.append(submission.selftext)
+                    if any(self.is_toxic(text) for text in texts):
                         continue
-                    if self.on_topic(submission.title,self.topic_list):
-                        print("Generating a comment on submission "+submission.id)
+                    if self.linkpost_only==2 and not submission.is_self:
+                        # force reply to image posts
                         self.make_comment(submission)
+                        continue
+                    candidates.append(submission)
+                    if len(candidates) >= 10:
+                        batch, candidates = candidates, []
+                        self.comment_on_topical(batch)
             except:
                 print("PRAW error, restarting")
+                time.sleep(10) # don't hammer Reddit while it is failing
 
     def watch_inbox(self):
-        while True: # not sure if this line is necessary
+        idle_backoff = 1
+        while True: # the stream ends when PRAW raises, so restart it here
             try:
                 for item in self.reddit.inbox.stream(pause_after=0, skip_existing=True):
                     if not item:
+                        # nothing new; with pause_after=0 PRAW polls again at once unless we wait
+                        time.sleep(idle_backoff)
+                        idle_backoff = min(idle_backoff*2, 30)
                         continue
+                    idle_backoff = 1
                     if isinstance(item, praw_Message):
                         # it's actually a message
                         # if item.author.name==self.config['bot_operator'] and (self.config['kill_phrase'] in item.body):
                         #     item.mark_read()
                         #     self.shutdown()
-                        if self.config['dynamic_prompt']:
+                        if self.dynamic_prompt:
                             if item.subject and item.body:
-                                if self.is_toxic(item.subject):
+                                if self.bad_keyword(item.subject) or self.is_toxic(item.subject):
                                     item.reply(body="Backstory is toxic, rejected...")
                                     continue
-                                self.bot_backstory = 'u/{} is {}'.format(self.config['bot_username'], item.subject)
+                                self.bot_backstory = 'u/{} is {}'.format(self.bot_username, item.subject)
                                 user_topic_list = item.body.split(',')[:10]
                                 if user_topic_list:
                                     self.topic_list = user_topic_list
@@ -554,27 +811,28 @@ class reddit_bot:
                     if not item.author:
                         item.mark_read()
                         continue
+                    # local checks first, so rejected comments never reach the toxicity API
                     if self.bad_keyword(item.body):
                         print("Bad keyword found, skipping...")
                         item.mark_read()
                         continue
-                    if self.is_toxic(item.body):
-                        print("Comment is toxic, skipping...")
+                    if item.fullname in self._replied_to:
                         item.mark_read()
                         continue
-                    already_replied = False
-                    item.replies.replace_more(limit=None)
-                    for reply in item.replies:
-                        if reply.author == self.me:
-                            already_replied = True
-                            break
-                    if already_replied:
+                    if not self.check_budget(item.body):
+                        # any reply prompt contains the comment, so it could not fit either
+                        print("Not enough characters left in budget, skipping...")
+                        item.mark_read()
+                        continue
+                    if self.is_toxic(item.body):
+                        print("Comment is toxic, skipping...")
                         item.mark_read()
                         continue
                     print('Checking comment "{}"'.format(item.body))
-                    if item.parent_id[:2]=='t3' and self.config['force_top_reply']:
+                    if item.parent_id[:2]=='t3' and self.force_top_reply:
                         self.generate_reply(item)
-                    elif self.check_budget(item.body) and words_below(item.body, 1000):
+                    elif words_below(item.body, 1000):
+                        # the budget was already checked above; only the length limit is left
                         if item.was_comment:
                             # get the keywords of the thing to which the commenter was responding
                             item_parent = item.parent()
@@ -596,6 +854,7 @@ class reddit_bot:
                     item.mark_read()
             except:
                 print("PRAW error, restarting")
+                time.sleep(10) # don't hammer Reddit while it is failing
 
     def submission_loop(self):
         for t in self.config['post_schedule']['mon']:
@@ -614,15 +873,15 @@ class reddit_bot:
             schedule.every().sunday.at(t).do(self.make_post)
         while True:
             schedule.run_pending()
-            time.sleep(1)
+            # sleep until the next post is due rather than waking every second
+            # (capped, so a clock change can't leave the loop asleep for days)
+            idle = schedule.idle_seconds()
+            if idle is None:
+                idle = 600
+            time.sleep(min(max(idle, 1), 600))
 
     def run(self):
-        print("Bot named {} running on {}".format(self.config['bot_username'],self.config['bot_subreddit']))
-        if not self.config['post_schedule']:
-            print("No posts scheduled!")
-        else:
-            print("Launching submission writer")
-            self.submission_writer.start()
+        print("Bot named {} running on {}".format(self.bot_username,self.config['bot_subreddit']))
         # don't bother running submission reader if bot has no interests
         if self.config['read_posts']:
             print("Scanning for posts on the following topics: "+", ".join(self.topic_list))
@@ -631,6 +890,12 @@ class reddit_bot:
             print("Bot will not read submissions.")
         print("Launching inbox reader")
         self.inbox_reader.start()
+        # the post schedule runs on the main thread, which would otherwise sit idle
+        if not self.config['post_schedule']:
+            print("No posts scheduled!")
+        else:
+            print("Launching submission writer")
+            self.submission_loop()
 
     def shutdown(self):
         sys.exit()
@@ -1,12 +1,17 @@
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import re
 
+# shared keep-alive session, so successive inference calls reuse the TLS connection
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=8))
+
 # function for Huggingface API calls
 def query(payload, model_path, headers):
     API_URL = "https://api-inference.huggingface.co/models/" + model_path
     for retry in range(3):
-        response = requests.post(API_URL, headers=headers, json=payload)
+        response = _session.post(API_URL, headers=headers, json=payload)
         if response.status_code == requests.codes.ok:
             try:
                 results = response.json()
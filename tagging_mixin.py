@@ -33,6 +33,8 @@ class TaggingMixin():
 
     _end_tag = '<|'
 
+    _tag_re = re.compile(r'(\<\|[\w\/ ]*\|\>)')
+
     def describe_image(self,url):
         # Settings below for Azure vision
         headers = {
@@ -263,7 +265,7 @@ class TaggingMixin():
 
     def remove_tags_from_string(self, input_string):
         # Removes any <|sor u/user|>, <|sost|> etc from a string
-        return re.sub(r'(\<\|[\w\/ ]*\|\>)', ' ', input_string).strip()
+        return self._tag_re.sub(' ', input_string).strip()
 
     def _decode_generated_text(self, text):
         return ftfy.fix_text(codecs.decode(text, "unicode_escape"))